@@ -1,29 +1,158 @@
 import os
+import asyncio
+import anyio
 import httpx
-from fastapi import FastAPI, Request
+from contextlib import asynccontextmanager
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
 from dotenv import load_dotenv
 from fastapi.responses import StreamingResponse
 import logging
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # --- ENV FILE ---
 load_dotenv()
 
 CHUTES_API_URL = "https://llm.chutes.ai/v1/chat/completions"
 
-# Initializes the FastAPI application
-app = FastAPI()
+# Gets the API key from the .env file once at startup
+CHUTES_API_KEY = os.getenv("CHUTES_API_TOKEN")
+
+if not CHUTES_API_KEY:
+    logger.error("CHUTES_API_TOKEN not found in .env file.")
+    raise ValueError("CHUTES_API_TOKEN not found in .env file.")
+
+logger.info("Using API key from .env file.")
+
+# Headers sent with every request to the Chutes AI API
+CHUTES_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {CHUTES_API_KEY}",
+    # Raw chunks are forwarded as-is, so ask for an uncompressed body
+    "Accept-Encoding": "identity"
+}
+
+# Upstream response headers passed through to the client on streaming responses
+FORWARDED_RESPONSE_HEADERS = {"content-type", "x-request-id", "retry-after"}
+
+# Manually defined list of models served by /v1/models
+MANUAL_MODEL_IDS = (
+    "casperhansen/deepseek-r1-distill-qwen-32b-awq",
+    "chutesai/Devstral-Small-2505",
+    "chutesai/Llama-4-Maverick-17B-128E-Instruct-FP8",
+    "chutesai/Llama-4-Scout-17B-16E-Instruct",
+    "chutesai/Mistral-Small-3.2-24B-Instruct-2506",
+    "deepseek-ai/DeepSeek-R1-0528",
+    "deepseek-ai/DeepSeek-R1-Distill-Llama-70B",
+    "LGAI-EXAONE/EXAONE-Deep-32B",
+    "LumiOpen/Llama-Poro-2-70B-Instruct",
+    "microsoft/MAI-DS-R1-FP8",
+    "MiniMaxAI/MiniMax-M1-80k",
+    "moonshotai/Kimi-Dev-72B",
+    "NousResearch/DeepHermes-3-Mistral-24B-Preview",
+    "OpenGVLab/InternVL3-78B",
+    "Qwen/Qwen2.5-Coder-32B-Instruct",
+    "Qwen/Qwen2.5-VL-72B-Instruct",
+    "Qwen/Qwen3-235B-A22B",
+    "RekaAI/reka-flash-3",
+    "Salesforce/Llama-xLAM-2-70b-fc-r",
+    "TheDrummer/Cydonia-24B-v2.1",
+    "thedrummer/skyfall-36b-v2",
+    "tplr/TEMPLAR-I",
+    "tngtech/DeepSeek-R1T-Chimera",
+    "unsloth/Mistral-Nemo-Instruct-2407"
+)
+
+# These bodies never change, so they are serialized once at startup
+MANUAL_MODELS_BODY = orjson.dumps({"data": [{"id": model_id} for model_id in MANUAL_MODEL_IDS]})
+HEALTH_CHECK_BODY = orjson.dumps({"status": "Proxy for Chutes AI is online!"})
 
 # Creates an asynchronous HTTP client that will be reused for all requests.
 # This is more efficient than creating a new client for each call.
-client = httpx.AsyncClient()
+# HTTP/2 lets concurrent requests share one multiplexed connection to Chutes AI,
+# and the larger keep-alive pool avoids new TCP+TLS handshakes under load.
+client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(
+        max_keepalive_connections=100,
+        max_connections=200,
+        keepalive_expiry=90.0
+    ),
+    timeout=httpx.Timeout(300.0, connect=10.0)
+)
+
+# Closes the pooled connections when the server shuts down
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await client.aclose()
+
+# Initializes the FastAPI application
+app = FastAPI(lifespan=lifespan)
+
+# --- ADMISSION CONTROL ---
+# Limits how many requests to Chutes AI can be in flight at once. Extra requests
+# wait for a free slot instead of piling up on the connection pool.
+MAX_INFLIGHT_REQUESTS = int(os.getenv("MAX_INFLIGHT_REQUESTS", "64"))
+
+if MAX_INFLIGHT_REQUESTS < 1:
+    logger.error("MAX_INFLIGHT_REQUESTS must be at least 1.")
+    raise ValueError("MAX_INFLIGHT_REQUESTS must be at least 1.")
+
+admission_condition = asyncio.Condition()
+inflight_requests = 0
+
+async def acquire_slot():
+    global inflight_requests
+    async with admission_condition:
+        while inflight_requests >= MAX_INFLIGHT_REQUESTS:
+            await admission_condition.wait()
+        inflight_requests += 1
+
+async def release_slot():
+    global inflight_requests
+    async with admission_condition:
+        inflight_requests -= 1
+        admission_condition.notify(1)
+
+# --- STREAM FORWARDING ---
+# Streaming responses send the upstream SSE bytes to the client (SillyTavern)
+# untouched, as they arrive: no decoding or per-chunk logging.
+# If SillyTavern disconnects, Starlette stops iterating and UpstreamStreamingResponse
+# closes the upstream stream.
+class UpstreamStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that closes the upstream response and frees the admission
+    slot once the response is over.
+    Starlette never closes the body iterator, so cleanup placed in a body generator
+    is skipped when the client disconnects before the first chunk is read.
+    """
+
+    def __init__(self, content, response_stream: httpx.Response, **kwargs):
+        super().__init__(content, **kwargs)
+        self.response_stream = response_stream
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Shielded so the cleanup still completes if the request is cancelled
+            with anyio.CancelScope(shield=True):
+                try:
+                    # Releases the connection back to the pool
+                    await self.response_stream.aclose()
+                finally:
+                    await release_slot()
 
 # --- PROXY ROUTE DEFINITION ---
 # This is the main route. It will "listen" on /v1/chat/completions
 # and accept POST requests, just as SillyTavern expects from OpenAI.
+# It is also registered on /chat/completions to support OpenAI-compatible clients.
 @app.post("/v1/chat/completions")
+@app.post("/chat/completions")
 async def proxy_to_chutes(request: Request):
     """
     This function acts as the proxy.
@@ -33,110 +162,85 @@ async def proxy_to_chutes(request: Request):
     4. Sends the request and transmits the response back to SillyTavern.
     """
     
-    # Reads the body (payload) of the original request sent by SillyTavern
-    request_data = await request.json()
-    logging.info(f"Request data from SillyTavern: {request_data}")
-    
-    # Gets the headers of the original request (useful for Content-Type, etc.)
-    # and modifies them for our new request.
-    
-    # Gets the API key from the .env file
-    api_key_to_use = os.getenv("CHUTES_API_TOKEN")
-
-    if not api_key_to_use:
-        logging.error("CHUTES_API_TOKEN not found in .env file.")
-        raise ValueError("CHUTES_API_TOKEN not found in .env file.")
-
-    logging.info("Using API key from .env file.")
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key_to_use}"
-    }
+    # Reads the raw body (payload) of the original request sent by SillyTavern.
+    # The bytes are forwarded as-is; they are only decoded to look up "stream".
+    body = await request.body()
+    try:
+        request_data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Request body is not valid JSON.")
+    if not isinstance(request_data, dict):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON object.")
+    # Only the size is logged; formatting the whole prompt would be costly
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Request from SillyTavern: %d bytes", len(body))
 
     # Checks if the original request asked for streaming
     is_streaming = request_data.get("stream", False)
 
-    # Prepares the request for the Chutes AI API
-    req = client.build_request(
-        method="POST",
-        url=CHUTES_API_URL,
-        json=request_data,
-        headers=headers,
-        timeout=300.0
-    )
-
-    # If the request is for streaming, we need to handle it in a special way
-    if is_streaming:
-        # Opens a streaming connection with the Chutes API
-        response_stream = await client.send(req, stream=True)
-        
-        # Defines a generator function that will "pull" the pieces of the response
-        # as they arrive and send them back to the client (SillyTavern).
-        async def stream_generator():
-            async for chunk in response_stream.aiter_bytes():
-                logging.info(f"Streaming chunk from Chutes AI: {chunk.decode('utf-8', errors='ignore')}")
-                yield chunk
-        
-        # Returns a StreamingResponse that sends the data in real time.
-        return StreamingResponse(stream_generator(), media_type=response_stream.headers.get("content-type"))
+    # Waits for a free slot before contacting the Chutes API
+    await acquire_slot()
+    slot_handed_off = False
+    response_stream = None
+    try:
+        # If the request is for streaming, we need to handle it in a special way
+        if is_streaming:
+            # Opens a streaming connection with the Chutes API.
+            # The response is opened before the StreamingResponse is built so its
+            # status code and headers can be passed on to the client.
+            req = client.build_request(
+                method="POST",
+                url=CHUTES_API_URL,
+                content=body,
+                headers=CHUTES_HEADERS
+            )
+            response_stream = await client.send(req, stream=True)
+
+            # Returns a StreamingResponse that sends the data in real time,
+            # keeping the upstream status code and the headers clients rely on.
+            streaming_response = UpstreamStreamingResponse(
+                # No chunk_size here: httpx would hold bytes back until that many
+                # arrived, delaying each token until the buffer fills.
+                response_stream.aiter_raw(),
+                response_stream=response_stream,
+                status_code=response_stream.status_code,
+                headers={
+                    key: value for key, value in response_stream.headers.items()
+                    if key.lower() in FORWARDED_RESPONSE_HEADERS
+                },
+                media_type=response_stream.headers.get("content-type")
+            )
+            # From here on the response is responsible for releasing the slot
+            slot_handed_off = True
+            return streaming_response
     
-    # If it's not streaming, makes a normal request
-    else:
-        response = await client.send(req)
-        # Reads the response body as JSON
-        response_data = response.json()
-        logging.info(f"Raw response from Chutes AI: {response_data}")
-        return response_data
-
-# An optional "health" route to check if the server is running
+        # If it's not streaming, makes a normal request
+        else:
+            response = await client.post(CHUTES_API_URL, content=body, headers=CHUTES_HEADERS)
+            # Forwards the response body verbatim instead of parsing and re-encoding the JSON
+            return Response(
+                content=response.content,
+                media_type=response.headers.get("content-type", "application/json"),
+                status_code=response.status_code
+            )
+    finally:
+        if not slot_handed_off:
+            try:
+                if response_stream is not None:
+                    await response_stream.aclose()
+            finally:
+                await release_slot()
+
+# An optional "health" route to check if the server is running.
+# It is async because FastAPI runs plain def routes in a threadpool.
 @app.get("/")
-def health_check():
-    return {"status": "Proxy for Chutes AI is online!"}
+async def health_check():
+    return Response(content=HEALTH_CHECK_BODY, media_type="application/json")
 @app.get("/v1/models")
+@app.get("/models")
 async def get_manual_models():
     """
     Returns a manually defined list of models.
+    Also served on /models to support OpenAI-compatible clients.
     """
-    models = [
-        {"id": "casperhansen/deepseek-r1-distill-qwen-32b-awq"},
-        {"id": "chutesai/Devstral-Small-2505"},
-        {"id": "chutesai/Llama-4-Maverick-17B-128E-Instruct-FP8"},
-        {"id": "chutesai/Llama-4-Scout-17B-16E-Instruct"},
-        {"id": "chutesai/Mistral-Small-3.2-24B-Instruct-2506"},
-        {"id": "deepseek-ai/DeepSeek-R1-0528"},
-        {"id": "deepseek-ai/DeepSeek-R1-Distill-Llama-70B"},
-        {"id": "LGAI-EXAONE/EXAONE-Deep-32B"},
-        {"id": "LumiOpen/Llama-Poro-2-70B-Instruct"},
-        {"id": "microsoft/MAI-DS-R1-FP8"},
-        {"id": "MiniMaxAI/MiniMax-M1-80k"},
-        {"id": "moonshotai/Kimi-Dev-72B"},
-        {"id": "NousResearch/DeepHermes-3-Mistral-24B-Preview"},
-        {"id": "OpenGVLab/InternVL3-78B"},
-        {"id": "Qwen/Qwen2.5-Coder-32B-Instruct"},
-        {"id": "Qwen/Qwen2.5-VL-72B-Instruct"},
-        {"id": "Qwen/Qwen3-235B-A22B"},
-        {"id": "RekaAI/reka-flash-3"},
-        {"id": "Salesforce/Llama-xLAM-2-70b-fc-r"},
-        {"id": "TheDrummer/Cydonia-24B-v2.1"},
-        {"id": "thedrummer/skyfall-36b-v2"},
-        {"id": "tplr/TEMPLAR-I"},
-        {"id": "tngtech/DeepSeek-R1T-Chimera"},
-        {"id": "unsloth/Mistral-Nemo-Instruct-2407"}
-    ]
-    return {"data": models}
-
-@app.get("/models")
-async def get_manual_models_alias():
-    """
-    Alias for /v1/models to support OpenAI-compatible clients.
-    """
-    return await get_manual_models()
-
-
-@app.post("/chat/completions")
-async def proxy_to_chutes_no_v1(request: Request):
-    """
-    Alias for /v1/chat/completions to support OpenAI-compatible clients.
-    """
-    return await proxy_to_chutes(request)
\ No newline at end of file
+    return Response(content=MANUAL_MODELS_BODY, media_type="application/json")
\ No newline at end of file